@@ -9,25 +9,42 @@ This script scrapes the CNN US Edition sitemap for a given year and month, and e
     {
         'headline': <article headline>,
         'modified': <date article was last modified>,
-        'text':     <article full text>
+        'text':     <article full text>,
+        'keywords': <article meta keywords>
     }, ...
 ]
+
+Pass 'text' or 'keywords' as the first argument to export only that field alongside the headline and date.
 '''
 
+import asyncio
+import codecs
 import concurrent.futures as cf
+import contextlib
+import functools
+import importlib.util
+import itertools
 import json
 import logging
 import math
+import os
 import re
+import ssl
 import sys
+import threading
 import time
+from collections import namedtuple
 from datetime import datetime
 from pprint import pprint as pp
 
+import aiohttp
+import lxml.html
+import numpy as np
+import orjson
 import requests
-from bs4 import BeautifulSoup
+from lxml.etree import XPath
 from requests.adapters import HTTPAdapter
-from tqdm import tqdm  # the One True Import of import
+from tqdm.asyncio import tqdm  # the One True Import of import
 from urllib3.util.retry import Retry
 
 logfile = 'main-' + datetime.now().strftime('%Y-%m-%d-%H:%M:%S') + '.log'
@@ -38,7 +55,27 @@ logging.basicConfig(
     level=logging.INFO,
     datefmt='%Y-%m-%d %H:%M:%S')
 
-failed_urls = []
+# Concurrent connections to keep open per host, for both the requests and aiohttp pools.
+POOL_SIZE = 32
+
+# Retry policy for every GET, sitemap or article.
+RETRIES = 3
+BACKOFF_FACTOR = 0.3
+STATUS_FORCELIST = (500, 502, 504)
+
+# Only advertise Brotli if we can actually decode it. urllib3 and aiohttp accept either package.
+if importlib.util.find_spec('brotli') or importlib.util.find_spec('brotlicffi'):
+    ACCEPT_ENCODING = 'gzip, deflate, br'
+else:
+    ACCEPT_ENCODING = 'gzip, deflate'
+
+# One TLS context for every article connection, built up front so the CA store is loaded once.
+SSL_CONTEXT = ssl.create_default_context()
+
+HEADERS = {
+    'Accept-Encoding': ACCEPT_ENCODING,
+    'User-Agent': 'CNN Scraper 9000',
+}
 
 excluded_pages = [
     re.compile(r'cnn\-underscored'),
@@ -49,20 +86,67 @@ excluded_pages = [
     re.compile(r'week\-in\-review')
 ]
 
+# All of the above as one alternation, so filtering a url is a single scan.
+EXCLUDE_RE = re.compile('|'.join(f'(?:{exclude.pattern})' for exclude in excluded_pages))
+
+'''
+Precompiled XPath queries for the sitemap and article pages.
+'''
+SITEMAP_XP = XPath(
+    r".//a[re:test(@href, '/\d{4}/\d{2}/\d{2}/')]/@href",
+    namespaces={'re': 'http://exslt.org/regular-expressions'},
+    smart_strings=False)
+# One descendant walk, rather than a union of three that each scan the whole page.
+PARA_XP = XPath(
+    ".//*[(self::p or self::div) and contains(@class, 'body__paragraph')"
+    " or self::p and contains(@class, 'paragraph inline-placeholder')]")
+META_XP = XPath(".//meta[@itemprop]")
+KEYWORDS_XP = XPath(".//meta[@name='keywords']/@content", smart_strings=False)
+
+'''
+HTML parser for a given charset, built once per thread and reused. With no charset, libxml2 goes by the page's own <meta charset>.
+'''
+def html_parser(encoding):
+    #A parser instance only parses one document at a time, so pool threads sharing one would take turns.
+    return thread_html_parser(threading.get_ident(), encoding)
+
+@functools.lru_cache()
+def thread_html_parser(thread_id, encoding):
+    try:
+        return lxml.html.HTMLParser(encoding=encoding)
+    except LookupError:
+        #Some names Python accepts (e.g. 'latin-1') aren't ones libxml2 knows.
+        logging.warning(f'libxml2 does not know charset {encoding!r}, falling back to the page\'s own.')
+        return lxml.html.HTMLParser()
+
+'''
+The given charset if Python knows it, otherwise None so the page's own <meta charset> gets used instead.
+'''
+def known_charset(encoding):
+    if encoding is None:
+        return None
+    try:
+        codecs.lookup(encoding)
+    except LookupError:
+        logging.warning(f'Unknown charset {encoding!r}, falling back to the page\'s own.')
+        return None
+    return encoding
+
 '''
-Soupify.
+Treeify. Takes the raw page bytes and the charset the server declared for them, if any.
 '''
-def get_soup(page):
-  soup = BeautifulSoup(page, 'html.parser')
-  return soup
+def get_tree(page, encoding=None):
+  tree = lxml.html.fromstring(page, parser=html_parser(known_charset(encoding)))
+  return tree
 
 '''
 Requests session for get_html
 '''
 def requests_session(
-    retries = 3,
-    backoff_factor = 0.3,
-    status_forcelist=(500, 502, 504),
+    retries = RETRIES,
+    backoff_factor = BACKOFF_FACTOR,
+    status_forcelist=STATUS_FORCELIST,
+    pool_size = POOL_SIZE,
     session=None,
     ):
 
@@ -74,26 +158,48 @@ def requests_session(
         backoff_factor=backoff_factor,
         status_forcelist=status_forcelist,
     )
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=retry,
+    )
     session.mount('http://', adapter)
     session.mount('https://', adapter)
     return session
 
+'''
+Shared session, built once per process so keep-alive connections get reused across get_html calls.
+'''
+@functools.lru_cache()
+def get_session():
+    session = requests_session()
+    session.headers.update(HEADERS)
+    return session
 
 '''
-Get raw HTML.
+Charset declared in a Content-Type header, or None if there isn't one.
+'''
+def declared_charset(content_type):
+    for param in content_type.split(';')[1:]:
+        key, _, value = param.strip().partition('=')
+        if key.lower() == 'charset':
+            return value.strip('"\' ') or None
+    return None
+
+'''
+Get raw HTML as bytes. Returns the page and its declared charset, or (None, None) on failure.
 '''
 
 def get_html(url):
     try:
-        page = requests_session().get(url, timeout=10)
-        text = page.text
-        return text
+        page = get_session().get(url, timeout=10)
+        #Raw bytes; page.text would run charset detection over the whole body.
+        #page.encoding isn't used either, since requests defaults text/* to ISO-8859-1 when no charset is given.
+        return page.content, declared_charset(page.headers.get('Content-Type', ''))
     except Exception:
         logging.exception(f'Failure on {url}')
         logging.error(f'Failure on {url}')
-        failed_urls.append(url)
-        return
+        return None, None
 
 def handle_failures(failures):
     #This is where we change what we want to do with URL requests that fail.
@@ -101,175 +207,262 @@ def handle_failures(failures):
         logging.info('Failed requests added to failed_urls.json')
         with open('failed_urls.json', 'w') as f:
             json.dump(failures, f)
+    elif os.path.exists('failed_urls.json'):
+        #Don't leave a previous run's failures lying around.
+        os.remove('failed_urls.json')
     return
 
 '''
-Parse links from soup.
+Parse article links from tree, dropping any excluded pages.
 '''
-def get_soup_links(soup):
-    re_article = re.compile(r'/\d{4}/\d{2}/\d{2}/')
-    links = []
-    for link in soup.find_all('a', href=re_article):
-        out_link = link.get('href')
-        links.append(out_link)
-    return links
+def get_tree_links(tree):
+    return [url for url in SITEMAP_XP(tree) if not EXCLUDE_RE.search(url)]
 
 '''
-Scrape CNN US sitemap for given year, month. Returns list of all article urls.
+Scrape CNN US sitemap for given year, month. Returns list of all article urls, and list of failed urls.
 '''
 def crawl_links_month(year:int, month:int):
-    failed_urls = []
     url_str = r'https://us.cnn.com/article/sitemap-{}-{}.html'.format(year,month)
-    page = get_html(url_str)
-    soup = get_soup(page)
-    all_links = get_soup_links(soup)
-    handle_failures(failed_urls)
-    clean_links = []
-    for url in all_links:
-        valid = True
-        for exclude in excluded_pages:
-            if re.search(exclude, url) != None:
-                valid = False
-        if valid:
-            clean_links.append(url)
-    return clean_links
-
-'''
-Scrape CNN US sitemap for given full year. Returns list of all article urls. This might void your warranty.
+    page, encoding = get_html(url_str)
+    if page is None:
+        return [], [url_str]
+    tree = get_tree(page, encoding)
+    all_links = get_tree_links(tree)
+    return all_links, []
+
+'''
+Worker for crawl_links_year. Returns the sitemap url and its article urls, or None for the links if that month fails.
+'''
+def month_worker(year:int, month:int):
+    url_str = r'https://us.cnn.com/article/sitemap-{}-{}.html'.format(year,month)
+    page, encoding = get_html(url_str)
+    if page is None:
+        return url_str, None
+    try:
+        tree = get_tree(page, encoding)
+        return url_str, get_tree_links(tree)
+    except Exception:
+        logging.exception(f'Failed to parse {url_str}')
+        return url_str, None
+
+'''
+Scrape CNN US sitemap for given full year. Returns list of all article urls, and list of failed urls. This might void your warranty.
 '''
 def crawl_links_year(year:int):
-    all_links = []
     failed_urls = []
-    for i in tqdm(range(1,13)):
-        try:
-            url_str = r'https://us.cnn.com/article/sitemap-{}-{}.html'.format(year,i)
-            page = get_html(url_str)
-            soup = get_soup(page)
-            links = get_soup_links(soup)
-            all_links += links
-        except Exception as e:
-            print(e)
-            continue
-    handle_failures(failed_urls)
-    clean_links = []
-    for url in all_links:
-        valid = True
-        for exclude in excluded_pages:
-            if re.search(exclude, url) != None:
-                valid = False
-        if valid:
-            clean_links.append(url)
-    return clean_links
-
-'''
-Attempt to retrive a metadata tag about an article page.
-'''
-def parse_meta(soup, attr, **kwargs):
-    try:
-        result = soup.find('meta', attrs=kwargs)[attr]
-    except:
-        result = None
-    return result
+    #The monthly sitemaps are independent, so fetch all twelve at once.
+    #Build the shared session up front; lru_cache doesn't lock, so racing threads would each make their own.
+    get_session()
+    with cf.ThreadPoolExecutor(max_workers=12) as executor:
+        months = executor.map(functools.partial(month_worker, year), range(1,13))
+        chunks = []
+        for url_str, links in tqdm(months, total=12):
+            if links is None:
+                failed_urls.append(url_str)
+            else:
+                chunks.append(links)
+    all_links = list(itertools.chain.from_iterable(chunks))
+    return all_links, failed_urls
 
 '''
-Parse article from soup. Return dict of parsed article deliciousness.
+Collect the itemprop metadata tags about an article page in one pass. Returns dict of itemprop: content.
+'''
+def parse_meta(tree):
+    metas = {}
+    for meta in META_XP(tree):
+        #Keep the first tag for each itemprop, like a find() would.
+        metas.setdefault(meta.get('itemprop'), meta.get('content'))
+    return metas
+
 '''
-def parse_article(soup):
-    re_paragraph = re.compile(r'body__paragraph')
-    re_para_alt = re.compile(r'paragraph inline\-placeholder')
-    paras = []
+Parse article from tree. Return dict of parsed article deliciousness.
+'''
+def parse_article(tree):
     #CNN, annoyingly, puts the first paragraph of the article in a p tag,
-    #and each subsequent paragraph in a div tag.
-    for para in soup.find_all('p', class_=re_paragraph):
-        if not para == '':
-            paras.append(para.text)
-    for para in soup.find_all('div', class_=re_paragraph):
-        if not para == '':
-            paras.append(para.text)
-    for para in soup.find_all('p', class_=re_para_alt):
-        if not para == '':
-            paras.append(para.text)
-    text = ''.join(paras)
-    modified = parse_meta(soup, 'content', **{'itemprop':'dateModified'})
-    headline = parse_meta(soup, 'content', **{'itemprop':'alternativeHeadline'})
+    #and each subsequent paragraph in a div tag. PARA_XP returns both in document order.
+    #Skip empty and whitespace-only paragraphs so they don't leave stray whitespace in the text.
+    paras = (para.text_content() for para in PARA_XP(tree))
+    text = ''.join(para for para in paras if para.strip())
+    metas = parse_meta(tree)
+    modified = metas.get('dateModified')
+    headline = metas.get('alternativeHeadline')
     if headline == None:
-        headline = parse_meta(soup, 'content', **{'itemprop': 'headline'})
+        headline = metas.get('headline')
+    keywords = KEYWORDS_XP(tree)
     article = {
       'headline': headline,
       'modified': modified,
       'text': text,
+      'keywords': keywords[0] if keywords else None,
     }
     
     return article
 
 '''
-Worker for ThreadPoolExecutor
+Fetch raw HTML for one article on the shared aiohttp session, retrying like requests_session does.
+Returns the page bytes, their charset, and how long the fetch took.
 '''
-def thread_worker(url_str):
-    results = {}
+async def fetch(session, semaphore, url):
+    page = None
+    encoding = None
+    async with semaphore:
+        html_tic = time.perf_counter()
+        for attempt in range(RETRIES + 1):
+            try:
+                async with session.get(url) as resp:
+                    resp.raise_for_status()
+                    page = await resp.read()
+                    encoding = resp.charset
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                retryable = not isinstance(e, aiohttp.ClientResponseError) or e.status in STATUS_FORCELIST
+                if retryable and attempt < RETRIES:
+                    await asyncio.sleep(BACKOFF_FACTOR * (2 ** attempt))
+                    continue
+                logging.exception(f'Failure on {url}')
+                logging.error(f'Failure on {url}')
+            except Exception:
+                logging.exception(f'Failure on {url}')
+                logging.error(f'Failure on {url}')
+            break
+        html_toc = time.perf_counter()
+    return page, encoding, (html_toc - html_tic)
 
-    html_tic = time.perf_counter()
-    page = get_html(url_str)
-    html_toc = time.perf_counter()
+'''
+One parsed article. times holds (html, tree, parse) durations in seconds.
+'''
+ArticleResult = namedtuple('ArticleResult', ['headline', 'modified', 'text', 'keywords', 'times'])
 
-    soup_tic = time.perf_counter()
-    soup = get_soup(page)
-    soup_toc = time.perf_counter()
+'''
+Exported JSON record for one article, per the schema at the top of this file. Fields left out by the mode are dropped.
+'''
+def article_record(result):
+    record = {
+        'headline': result.headline,
+        'modified': result.modified,
+    }
+    if result.text is not None:
+        record['text'] = result.text
+    if result.keywords is not None:
+        record['keywords'] = result.keywords
+    return record
 
-    parse_tic = time.perf_counter()
-    article = parse_article(soup)
-    parse_toc = time.perf_counter()
+TIMES_DTYPE = np.dtype([('html', 'f8'), ('tree', 'f8'), ('parse', 'f8')])
 
-    results['headline'] = article['headline']
-    results['modified'] = article['modified']
+'''
+Worker for ThreadPoolExecutor. Treeify and parse one fetched page. html_time is how long fetch took for it.
+'''
+def parse_worker(url_str, page, encoding, html_time):
+    tic = time.perf_counter()
+    tree = get_tree(page, encoding)
+    tree_toc = time.perf_counter()
+    article = parse_article(tree)
+    parse_toc = time.perf_counter()
 
+    text = None
     if sys.argv[1] != 'keywords':
         if article['text'] != '':
-            results['article_text'] = article['text']
+            text = article['text']
         else:
             logging.warning(f'Url {url_str} produced empty article.')
 
+    keywords = None
     if sys.argv[1] != 'text':
-        results['keywords'] = article['keywords']
-    
-    results['html_time'] = (html_toc - html_tic)
-    results['soup_time'] = (soup_toc - soup_tic)
-    results['parse_time'] = (parse_toc - parse_tic)
-
-    return results
+        keywords = article['keywords']
+
+    return ArticleResult(
+        headline=article['headline'],
+        modified=article['modified'],
+        text=text,
+        keywords=keywords,
+        times=(html_time, tree_toc - tic, parse_toc - tree_toc),
+    )
 
 '''
-Parse many articles, given a list of urls.
+Fetch one article on the event loop, then hand the page off to the thread pool for parsing.
+Returns (result, failed_url). result is None if either step fails; failed_url is set only if the fetch failed.
 '''
-def parse_many(url_list):
-    parsed_list = []
-    html_times = []
-    soup_times = []
-    parse_times = []
+async def fetch_and_parse(session, semaphore, executor, url_str):
+    page, encoding, html_time = await fetch(session, semaphore, url_str)
+    if page is None:
+        return None, url_str
+    loop = asyncio.get_running_loop()
+    try:
+        result = await loop.run_in_executor(executor, parse_worker, url_str, page, encoding, html_time)
+    except Exception:
+        logging.exception(f'Failed to parse {url_str}')
+        return None, None
+    return result, None
+
+async def parse_many_async(url_list, write_article):
+    n_parsed = 0
+    times_arr = np.empty(len(url_list), dtype=TIMES_DTYPE)
+    n_timed = 0
     failed_urls = []
 
-    with tqdm(total=len(url_list)) as pbar:
-        with cf.ProcessPoolExecutor(max_workers=32) as executor:
-            futures = {executor.submit(thread_worker, arg): arg for arg in url_list}
-            for future in cf.as_completed(futures):
-                results = future.result()
-                if 'article_text' in results.keys():
-                    parsed_list.append(results['article_text'])
-                html_times.append(results['html_time'])
-                soup_times.append(results['soup_time'])
-                parse_times.append(results['parse_time'])
-                pbar.update(1)
-    
-    handle_failures(failed_urls)
+    #Everything goes to one host, so let in only as many requests as the connector will open to it.
+    #Otherwise the extras queue for a connection, and that wait counts toward their timeout and html time.
+    semaphore = asyncio.Semaphore(POOL_SIZE)
+    connector = aiohttp.TCPConnector(
+        limit=100,
+        limit_per_host=POOL_SIZE,
+        use_dns_cache=True,
+        ttl_dns_cache=600,
+        ssl=SSL_CONTEXT,
+    )
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=10)
+
+    #lxml drops the GIL while it parses, so threads get the same parallelism without
+    #pickling every page and result across process boundaries.
+    with cf.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=HEADERS) as session:
+            tasks = [fetch_and_parse(session, semaphore, executor, url) for url in url_list]
+            #Write each article out as soon as it's done, rather than holding them all until the end.
+            for task in tqdm.as_completed(tasks):
+                result, failed_url = await task
+                if failed_url is not None:
+                    failed_urls.append(failed_url)
+                #Skip articles that failed to fetch or parse, so they don't skew the timing stats.
+                if result is None:
+                    continue
+                if result.text is not None or result.keywords is not None:
+                    write_article(article_record(result))
+                    n_parsed += 1
+                times_arr[n_timed] = result.times
+                n_timed += 1
+
+    return n_parsed, times_arr[:n_timed], failed_urls
 
-    return parsed_list, html_times, soup_times, parse_times
+'''
+Parse many articles, given a list of urls. Each parsed article is passed to write_article as it completes.
+Returns number of articles written, their timings, and list of failed urls.
+'''
+def parse_many(url_list, write_article):
+    return asyncio.run(parse_many_async(url_list, write_article))
 
 '''
-Export parsed articles to JSON.
+Export parsed articles to JSON. Yields a function that appends one article to the file's JSON array.
+Writes to a .part file and only renames it into place once the run finishes, so a failed run leaves no half-written JSON.
 '''
-def output_to_json(parsed_articles:list, filename:str):
-    with open(filename, 'w', encoding='utf-8') as f:
-        json.dump(parsed_articles, f, ensure_ascii=False, indent=4)
+@contextlib.contextmanager
+def output_to_json(filename:str):
+    part_filename = filename + '.part'
+    try:
+        with open(part_filename, 'wb') as f:
+            f.write(b'[')
+            n_written = 0
+
+            def write_article(article):
+                nonlocal n_written
+                f.write(b',\n  ' if n_written else b'\n  ')
+                f.write(orjson.dumps(article))
+                n_written += 1
+
+            yield write_article
+            f.write(b'\n]' if n_written else b']')
+        os.replace(part_filename, filename)
+    finally:
+        if os.path.exists(part_filename):
+            os.remove(part_filename)
 
 '''
 MAIN
@@ -293,7 +486,7 @@ def main():
         if mode == '1':  #scrape a year
             print('Scraping ...')
             month = 'all'
-            links = crawl_links_year(year)
+            links, failed_urls = crawl_links_year(year)
             print(f'\nFound {len(links)} articles. Parsing ...')
         elif mode == '2':  #scrape a month
             if len(sys.argv) < 4:
@@ -301,28 +494,35 @@ def main():
             else:
                 month = int(sys.argv[3])
             print('Scraping ...')
-            links = crawl_links_month(year, month)
+            links, failed_urls = crawl_links_month(year, month)
             print(f'\nFound {len(links)} articles. Parsing ...')
         else:
             print('Invalid input.')
             raise Exception
 
-        parsed_articles, html_times, soup_times, parse_times = parse_many(links)
-        print(f'\nParsed {len(parsed_articles)}. Exporting ...')
-
-        performance_timing = [
-            '\nPerformance timing:',
-            f'\nget_html()\t\tMin: {min(html_times):.6f}\tMax: {max(html_times):.6f}\tAvg: {sum(html_times)/len(html_times):.6f}',
-            f'get_soup()\t\tMin: {min(soup_times):.6f}\tMax: {max(soup_times):.6f}\tAvg: {sum(soup_times)/len(soup_times):.6f}',
-            f'parse_article()\t\tMin: {min(parse_times):.6f}\tMax: {max(parse_times):.6f}\tAvg: {sum(parse_times)/len(parse_times):.6f}',
-        ]
-        for line in performance_timing:
-            print(line)
-            logging.info(line)
-
         filename = f'CNN_{year}_{month}.json'
-        output_to_json(parsed_articles, filename)
-        print(f'\nExported to {filename}. Have a blessed day!')
+        with output_to_json(filename) as write_article:
+            n_parsed, times_arr, failed_articles = parse_many(links, write_article)
+        failed_urls += failed_articles
+        handle_failures(failed_urls)
+        print(f'\nParsed {n_parsed}. Exported to {filename}.')
+
+        #Nothing fetched means nothing timed, and min/max of an empty array would raise.
+        if len(times_arr) > 0:
+            html_times = times_arr['html']
+            tree_times = times_arr['tree']
+            parse_times = times_arr['parse']
+            performance_timing = [
+                '\nPerformance timing:',
+                f'\nget_html()\t\tMin: {html_times.min():.6f}\tMax: {html_times.max():.6f}\tAvg: {html_times.mean():.6f}',
+                f'get_tree()\t\tMin: {tree_times.min():.6f}\tMax: {tree_times.max():.6f}\tAvg: {tree_times.mean():.6f}',
+                f'parse_article()\t\tMin: {parse_times.min():.6f}\tMax: {parse_times.max():.6f}\tAvg: {parse_times.mean():.6f}',
+            ]
+            for line in performance_timing:
+                print(line)
+                logging.info(line)
+
+        print('\nHave a blessed day!')
     except Exception:
         logging.exception('It all went sideways!')
         logging.info(sys.argv)